@@ -0,0 +1,153 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from detector import IMGSZ, YOLODetector, decode_jpeg
+
+
+class StubModel:
+    """Stands for the ultralytics model: one detection per frame, and records the batches."""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, frames, **kwargs):
+        frames = frames if isinstance(frames, list) else [frames]
+        self.batch_sizes.append(len(frames))
+        data = torch.tensor([[10.0, 20.0, 110.0, 220.0, 0.9, 0.0]])
+        return [SimpleNamespace(boxes=SimpleNamespace(data=data), names={0: 'person'}) for _ in frames]
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    # Run on the CPU with the PyTorch weights, and stub the model out
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    detector = YOLODetector(
+        os.path.join(os.path.dirname(__file__), 'yolov8n.pt'), max_delay_ms=20
+    )
+    detector.model = StubModel()
+    return detector
+
+
+def frame():
+    return np.zeros((240, 320, 3), dtype=np.uint8)
+
+
+def test_detect_async_batches_concurrent_calls(detector):
+    async def main():
+        return await asyncio.gather(detector.detect_async(frame()), detector.detect_async(frame()))
+
+    outputs = asyncio.run(main())
+    assert detector.model.batch_sizes == [2]
+    for _, detections in outputs:
+        assert detections == [{'class': 'person', 'confidence': pytest.approx(0.9), 'bbox': [10, 20, 110, 220]}]
+
+
+def test_detect_async_max_delay(detector):
+    async def main():
+        first = asyncio.create_task(detector.detect_async(frame()))
+        # Sent after the deadline of the first batch
+        await asyncio.sleep(0.1)
+        await detector.detect_async(frame())
+        await first
+
+    asyncio.run(main())
+    assert detector.model.batch_sizes == [1, 1]
+
+
+def test_detect_async_max_batch_size(detector):
+    detector.max_batch_size = 2
+
+    async def main():
+        await asyncio.gather(*(detector.detect_async(frame()) for _ in range(3)))
+
+    asyncio.run(main())
+    assert detector.model.batch_sizes == [2, 1]
+
+
+def test_detect_async_on_a_new_event_loop(detector):
+    # The worker of the first loop is gone: the second loop gets its own
+    asyncio.run(detector.detect_async(frame()))
+    _, detections = asyncio.run(asyncio.wait_for(detector.detect_async(frame()), timeout=5))
+    assert len(detections) == 1
+    assert detector.model.batch_sizes == [1, 1]
+
+
+def test_detect_async_failed_batch(detector, monkeypatch):
+    def fail(frames):
+        raise RuntimeError('inference failed')
+
+    async def main():
+        with monkeypatch.context() as patch:
+            patch.setattr(detector, 'detect_batch', fail)
+            results = await asyncio.gather(
+                detector.detect_async(frame()), detector.detect_async(frame()), return_exceptions=True
+            )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        # The worker keeps serving the next frames
+        return await detector.detect_async(frame())
+
+    _, detections = asyncio.run(main())
+    assert len(detections) == 1
+
+
+def test_detect_batch(detector):
+    outputs = detector.detect_batch([frame(), frame(), frame()])
+    assert detector.model.batch_sizes == [3]
+    assert [len(detections) for _, detections in outputs] == [1, 1, 1]
+
+
+def jpeg(image):
+    ok, buffer = cv2.imencode('.jpg', image)
+    assert ok
+    return buffer.tobytes()
+
+
+def test_letterbox_round_trip():
+    # 1280x720 frame: scaled by 0.5 to 640x360, padded by 140 pixels on the top and bottom
+    ratio, new_w, new_h, pad_x, pad_y = YOLODetector._letterbox_params(720, 1280)
+    assert ratio == 0.5
+    assert (new_w, new_h) == (IMGSZ, 360)
+    assert (pad_x, pad_y) == (0, 140)
+
+    frame_boxes = np.array([[100, 50, 400, 300], [0, 0, 1280, 720]], dtype=np.float32)
+    data = np.zeros((2, 6), dtype=np.float32)
+    data[:, [0, 2]] = frame_boxes[:, [0, 2]] * ratio + pad_x
+    data[:, [1, 3]] = frame_boxes[:, [1, 3]] * ratio + pad_y
+
+    data = YOLODetector._unletterbox(data, ratio, pad_x, pad_y, 1280, 720)
+    np.testing.assert_allclose(data[:, :4], frame_boxes)
+
+
+def test_unletterbox_clips_to_frame():
+    ratio, _, _, pad_x, pad_y = YOLODetector._letterbox_params(720, 1280)
+    # Box reaching into the padding on both sides
+    data = np.array([[-10, 100, 650, 550, 0.9, 0]], dtype=np.float32)
+
+    data = YOLODetector._unletterbox(data, ratio, pad_x, pad_y, 1280, 720)
+    np.testing.assert_allclose(data[0, :4], [0, 0, 1280, 720])
+
+
+def test_decode_jpeg():
+    assert decode_jpeg(jpeg(np.zeros((48, 64, 3), dtype=np.uint8))).shape == (48, 64, 3)
+
+
+def test_decode_invalid_jpeg():
+    with pytest.raises(ValueError):
+        decode_jpeg(b'not a jpeg')
+
+
+def test_detect_jpeg(detector):
+    detections = detector.detect_jpeg(jpeg(frame()))
+    assert detections == [{'class': 'person', 'confidence': pytest.approx(0.9), 'bbox': [10, 20, 110, 220]}]
+
+
+def test_detect_invalid_jpeg(detector):
+    with pytest.raises(ValueError):
+        detector.detect_jpeg(b'not a jpeg')
+    assert detector.model.batch_sizes == []
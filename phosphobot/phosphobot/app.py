@@ -26,6 +26,7 @@ from phosphobot.endpoints import (
     training_router,
     update_router,
 )
+from phosphobot.endpoints.camera import start_loading_yolo_model
 from phosphobot.hardware import simulation_init, simulation_stop
 from phosphobot.models import ServerStatus
 from phosphobot.posthog import posthog, posthog_pageview
@@ -70,6 +71,8 @@ async def lifespan(app: FastAPI):
     simulation_init()
     # Initialize cameras
     cameras = get_all_cameras()
+    # Load YOLO (and build its TensorRT engine) in the background, before the first stream
+    start_loading_yolo_model()
     rcm = get_rcm()
     udp_server = get_udp_server()
 
@@ -0,0 +1,264 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+from loguru import logger
+from ultralytics import YOLO
+
+PostprocessResult = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# Detection overlay style
+_FONT = cv2.FONT_HERSHEY_SIMPLEX
+_GREEN = (0, 255, 0)
+
+
+def engine_path_for(model_path: str, imgsz: int, int8: bool = False) -> Path:
+    """
+    Path of the TensorRT engine exported from model_path, next to it and named after
+    its specialization (yolov8n.pt -> yolov8n_fp16_b1_640.engine), so that an engine
+    exported with other settings is never reused by mistake.
+    """
+    weights = Path(model_path)
+    precision = "int8" if int8 else "fp16"
+    return weights.with_name(f"{weights.stem}_{precision}_b1_{imgsz}.engine")
+
+
+def export_engine(
+    model_path: str,
+    imgsz: int,
+    int8: bool = False,
+    calib_data: Optional[str] = None,
+) -> Path:
+    """
+    Return the path of a TensorRT engine built from model_path.
+
+    The engine is exported once next to the weights (see engine_path_for) and reused
+    on the next startups. FP16 is used by default. INT8 needs a calibration dataset
+    yaml (calib_data) pointing to a few representative camera frames.
+
+    The engine is specialized for a single (1, 3, imgsz, imgsz) input. NMS is left
+    out of it, so that ultralytics can replay the engine as a CUDA graph.
+    """
+    engine_path = engine_path_for(model_path, imgsz, int8=int8)
+    if engine_path.exists():
+        return engine_path
+    if int8 and calib_data is None:
+        raise ValueError("INT8 export requires a calibration dataset (calib_data)")
+
+    # The export goes through an intermediate ONNX model next to the weights
+    onnx_path = Path(model_path).with_suffix(".onnx")
+    keep_onnx = onnx_path.exists()
+    logger.info(f"Exporting {model_path} to TensorRT engine (one time)")
+    exported = YOLO(model_path).export(
+        format="engine",
+        half=not int8,
+        int8=int8,
+        data=calib_data,
+        imgsz=imgsz,
+        batch=1,
+        device=0,
+        dynamic=False,
+        simplify=True,
+    )
+    Path(exported).rename(engine_path)
+    if not keep_onnx:
+        onnx_path.unlink(missing_ok=True)
+    return engine_path
+
+
+def check_engine_input(model: YOLO, imgsz: int) -> None:
+    """
+    Ensure a TensorRT engine model takes exactly a (1, 3, imgsz, imgsz) input.
+    Runs a first inference, which also warms the engine up.
+    """
+    model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz, verbose=False)
+    predictor = model.predictor
+    assert predictor is not None
+    input_shape = tuple(predictor.model.bindings["images"].shape)
+    if input_shape != (1, 3, imgsz, imgsz):
+        raise ValueError(
+            f"TensorRT engine has input shape {input_shape}, expected {(1, 3, imgsz, imgsz)}"
+        )
+
+
+def _postprocess_numpy(data: np.ndarray, conf_threshold: float) -> PostprocessResult:
+    """NumPy implementation of postprocess_detections."""
+    keep = np.flatnonzero(data[:, 4] >= conf_threshold)
+    kept = data[keep]
+    return (
+        keep,
+        kept[:, :4].astype(np.int32),
+        kept[:, 4].astype(np.float32),
+        kept[:, 5].astype(np.int32),
+    )
+
+
+def _postprocess_loop(data: np.ndarray, conf_threshold: float) -> PostprocessResult:
+    """Same as _postprocess_numpy, written as loops to be compiled by Numba."""
+    n_rows = data.shape[0]
+    n_kept = 0
+    for i in range(n_rows):
+        if data[i, 4] >= conf_threshold:
+            n_kept += 1
+
+    keep = np.empty(n_kept, dtype=np.int64)
+    boxes = np.empty((n_kept, 4), dtype=np.int32)
+    scores = np.empty(n_kept, dtype=np.float32)
+    class_ids = np.empty(n_kept, dtype=np.int32)
+    j = 0
+    for i in range(n_rows):
+        if data[i, 4] >= conf_threshold:
+            keep[j] = i
+            for k in range(4):
+                boxes[j, k] = np.int32(data[i, k])
+            scores[j] = data[i, 4]
+            class_ids[j] = np.int32(data[i, 5])
+            j += 1
+    return keep, boxes, scores, class_ids
+
+
+@lru_cache()
+def _get_postprocess() -> Callable[[np.ndarray, float], PostprocessResult]:
+    """
+    Compile the post-processing with Numba on the first detection, not at import.
+    Falls back to NumPy if Numba is missing or cannot compile (e.g. no cache
+    locator in a frozen build).
+    """
+    try:
+        from numba import njit
+
+        postprocess = njit(cache=True)(_postprocess_loop)
+        postprocess(np.zeros((1, 6), dtype=np.float32), 0.5)
+        return postprocess
+    except Exception as e:
+        logger.debug(
+            f"phosphobot: numba not available, detection post-processing will use NumPy: {e}"
+        )
+        return _postprocess_numpy
+
+
+def postprocess_detections(data: np.ndarray, conf_threshold: float) -> PostprocessResult:
+    """
+    Filter the [x1, y1, x2, y2, score, class_id] rows of YOLO detections by score.
+    Returns the kept row indices, int32 boxes, float32 scores and int32 class ids.
+    """
+    return _get_postprocess()(data, conf_threshold)
+
+
+def format_detections(
+    data: np.ndarray, names: Dict[int, str], conf_threshold: float
+) -> Tuple[np.ndarray, List[str], List[Dict[str, Any]]]:
+    """
+    Build the detections from the [x1, y1, x2, y2, score, class_id] rows of YOLO.
+    Returns the int32 [x1, y1, x2, y2] boxes to draw, their labels and the list of
+    detections with class names, confidence scores and bounding boxes.
+    """
+    # Numeric part (filtering, casts) in compiled code, strings in Python
+    keep, xyxy, score_array, class_id_array = postprocess_detections(data, conf_threshold)
+    bboxes = data[keep, :4].tolist()
+    scores = score_array.tolist()
+    class_ids = class_id_array.tolist()
+    detections = [
+        {"class": names[class_id], "confidence": score, "bbox": bbox}
+        for bbox, score, class_id in zip(bboxes, scores, class_ids)
+    ]
+    labels = [f"{names[class_id]}: {score:.2f}" for score, class_id in zip(scores, class_ids)]
+    return xyxy, labels, detections
+
+
+def draw_detections(frame: np.ndarray, xyxy: np.ndarray, labels: List[str]) -> None:
+    """Draw bounding boxes and labels in place on a frame, with OpenCV."""
+    for (x1, y1, x2, y2), label in zip(xyxy.tolist(), labels):
+        cv2.rectangle(frame, (x1, y1), (x2, y2), _GREEN, 2)
+        cv2.putText(frame, label, (x1, y1 - 10), _FONT, 0.5, _GREEN, 2)
+
+
+def _text_width(text: str) -> int:
+    return cv2.getTextSize(text, _FONT, 0.5, 2)[0][0]
+
+
+@lru_cache(maxsize=1024)
+def _text_tile(text: str, device: torch.device) -> Tuple[torch.Tensor, int, int, int]:
+    """
+    Rasterize text once, as cv2.putText draws it, into a boolean tile on device.
+    Returns the tile, the position of the text origin in the tile and the advance
+    of the text, where the next text starts.
+    """
+    (text_width, text_height), baseline = cv2.getTextSize(text, _FONT, 0.5, 2)
+    # Margin for the stroke thickness around the text box
+    margin = 4
+    tile = np.zeros((text_height + baseline + 2 * margin, text_width + 2 * margin), dtype=np.uint8)
+    origin_x, origin_y = margin, text_height + margin
+    cv2.putText(tile, text, (origin_x, origin_y), _FONT, 0.5, 255, 2)
+    # getTextSize adds the stroke thickness to the width, which cancels out here
+    advance = _text_width(text + "x") - _text_width("x")
+    return torch.from_numpy(tile > 0).to(device), origin_x, origin_y, advance
+
+
+def _label_pieces(label: str) -> List[str]:
+    """
+    Split a "class: score" label into the class part and the score characters,
+    so that the tiles are cached per class name and per glyph, not per score.
+    """
+    prefix, separator, score = label.rpartition(" ")
+    if not separator:
+        return [label]
+    return [prefix + separator, *score]
+
+
+@lru_cache()
+def _green(device: torch.device) -> torch.Tensor:
+    """The overlay color on device, uploaded once."""
+    return torch.tensor(_GREEN, dtype=torch.uint8, device=device)
+
+
+def draw_detections_on_tensor(image: torch.Tensor, xyxy: np.ndarray, labels: List[str]) -> None:
+    """
+    Draw bounding boxes and labels in place on a HxWx3 uint8 tensor, on its device.
+    The result is the same as draw_detections, except for the rounded box corners.
+
+    The boxes and labels are drawn into a single overlay mask, applied in one pass.
+    Only slices and tensor operations are used, no boolean indexing, so nothing
+    waits for the device.
+    """
+    if len(xyxy) == 0:
+        return
+    height, width = image.shape[:2]
+    mask = torch.zeros((height, width), dtype=torch.bool, device=image.device)
+
+    def clip_y(y: int) -> int:
+        return min(max(y, 0), height)
+
+    def clip_x(x: int) -> int:
+        return min(max(x, 0), width)
+
+    for (x1, y1, x2, y2), label in zip(xyxy.tolist(), labels):
+        # cv2.rectangle with a thickness of 2 covers 1 pixel on each side of an edge,
+        # so each edge is a 3 pixel band set with one slice
+        top, bottom = clip_y(y1 - 1), clip_y(y2 + 2)
+        left, right = clip_x(x1 - 1), clip_x(x2 + 2)
+        mask[top:clip_y(y1 + 2), left:right] = True
+        mask[clip_y(y2 - 1):bottom, left:right] = True
+        mask[top:bottom, left:clip_x(x1 + 2)] = True
+        mask[top:bottom, clip_x(x2 - 1):right] = True
+
+        # Add the cached tiles of the label, where cv2.putText would draw them
+        origin_x = x1
+        for piece in _label_pieces(label):
+            tile, tile_origin_x, tile_origin_y, advance = _text_tile(piece, image.device)
+            tile_top, tile_left = y1 - 10 - tile_origin_y, origin_x - tile_origin_x
+            origin_x += advance
+            # Clip the tile to the frame
+            frame_top, frame_bottom = clip_y(tile_top), clip_y(tile_top + tile.shape[0])
+            frame_left, frame_right = clip_x(tile_left), clip_x(tile_left + tile.shape[1])
+            if frame_top >= frame_bottom or frame_left >= frame_right:
+                continue
+            mask[frame_top:frame_bottom, frame_left:frame_right] |= tile[
+                frame_top - tile_top:frame_bottom - tile_top,
+                frame_left - tile_left:frame_right - tile_left,
+            ]
+
+    torch.where(mask[..., None], _green(image.device), image, out=image)
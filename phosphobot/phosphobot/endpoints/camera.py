@@ -1,67 +1,265 @@
-import base64
+import asyncio
+import threading
+from functools import lru_cache
 from typing import Dict, Optional
 import cv2
 import numpy as np
+import orjson
+import pybase64
+import torch
+import torchvision
 from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
     Request,
 )
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from loguru import logger
 from ultralytics import YOLO
 import os
 from pathlib import Path
 
 from phosphobot.camera import AllCameras, get_all_cameras
+from phosphobot.detection import (
+    check_engine_input,
+    draw_detections,
+    draw_detections_on_tensor,
+    export_engine,
+    format_detections,
+)
 
 router = APIRouter(tags=["camera"])
 
-# Initialize YOLO model
+# Multipart boundaries around each JPEG of the video stream
+_FRAME_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+_FRAME_SUFFIX = b'\r\n'
+
+try:
+    from turbojpeg import TJPF_BGR, TJPF_RGB, TurboJPEG
+
+    # libjpeg-turbo through PyTurboJPEG is faster than cv2.imencode
+    _turbojpeg: Optional[TurboJPEG] = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    logger.debug("phosphobot: libturbojpeg not available, JPEG encoding will use OpenCV")
+    _turbojpeg = None
+
+
+@lru_cache()
+def _nvjpeg_available() -> bool:
+    """
+    Whether JPEGs can be encoded on the GPU with nvJPEG (torchvision >= 0.19).
+    Checked on the first encoding, so CUDA is not initialized at startup.
+    """
+    if not torch.cuda.is_available():
+        return False
+    try:
+        torchvision.io.encode_jpeg(torch.zeros((3, 8, 8), dtype=torch.uint8, device="cuda"))
+    except Exception as e:
+        logger.debug(f"phosphobot: nvJPEG encoding not available, JPEG encoding will use the CPU: {e}")
+        return False
+    return True
+
+
+def _encode_jpeg_cuda(image: torch.Tensor, quality: int, rgb: bool) -> memoryview:
+    """Encode a HxWx3 uint8 CUDA tensor as JPEG with nvJPEG."""
+    tensor = image.permute(2, 0, 1)
+    if not rgb:
+        tensor = tensor.flip(0)  # BGR to RGB
+    jpeg = torchvision.io.encode_jpeg(tensor.contiguous(), quality=quality)
+    return jpeg.cpu().numpy().data
+
+
+def _encode_jpeg(
+    frame: cv2.typing.MatLike, quality: int, rgb: bool = False
+) -> bytes | memoryview:
+    """
+    Encode a frame as JPEG, on the GPU with nvJPEG if available, else with TurboJPEG
+    if available, else with OpenCV. The frame is BGR, or RGB if rgb is True.
+    """
+    # nvJPEG frees the CPU core that libjpeg would use for every frame of every stream.
+    # Depth frames (single channel or 16 bits) are encoded on the CPU
+    if (
+        isinstance(frame, np.ndarray)
+        and frame.ndim == 3
+        and frame.shape[2] == 3
+        and frame.dtype == np.uint8
+        and _nvjpeg_available()
+    ):
+        return _encode_jpeg_cuda(torch.from_numpy(frame).to("cuda"), quality, rgb)
+
+    if _turbojpeg is not None:
+        return _turbojpeg.encode(
+            frame, quality=quality, pixel_format=TJPF_RGB if rgb else TJPF_BGR
+        )
+
+    if rgb:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.data.cast("B")
+
+
+# YOLO model weights
 MODEL_PATH = str(Path(__file__).parent.parent.parent / 'inference' / 'yolo' / 'best.pt')
 if not os.path.exists(MODEL_PATH):
     logger.warning(f"Custom model {MODEL_PATH} not found, falling back to yolov8n.pt")
     MODEL_PATH = 'yolov8n.pt'
 
-try:
-    yolo_model = YOLO(MODEL_PATH)
-    yolo_model.conf = 0.5  # Confidence threshold
-    yolo_model.iou = 0.45  # NMS IoU threshold
-    yolo_model.max_det = 10  # Maximum number of detections
-    logger.info(f"Loaded YOLO model from {MODEL_PATH}")
-except Exception as e:
-    logger.error(f"Failed to load YOLO model: {str(e)}")
-    raise RuntimeError(f"Failed to initialize YOLO model: {str(e)}")
+# Run inference in FP16 on GPU, detection is not sensitive to the precision loss
+YOLO_HALF = torch.cuda.is_available()
+# Input size of the model
+YOLO_IMGSZ = 640
+# Confidence threshold of the detections
+YOLO_CONF = 0.5
+# The ultralytics predictor is not thread-safe, and each stream runs its inference
+# in a worker thread: only one inference runs at a time
+_yolo_lock = threading.Lock()
 
-def process_frame(frame: np.ndarray) -> tuple[np.ndarray, list[dict]]:
-    """Process frame with YOLO detection."""
+
+def load_yolo_model(model_path: str) -> YOLO:
+    """
+    Load the YOLO model. On a NVIDIA GPU, the weights are exported once to a
+    TensorRT engine (cached next to the weights, see export_engine) and the engine
+    is loaded instead.
+    """
+    if not torch.cuda.is_available():
+        return YOLO(model_path)
+
+    try:
+        engine_path = export_engine(model_path, YOLO_IMGSZ)
+    except Exception as e:
+        logger.warning(f"TensorRT export failed, using {model_path}: {str(e)}")
+        return YOLO(model_path)
+
+    yolo_model = YOLO(str(engine_path), task="detect")
+    try:
+        check_engine_input(yolo_model, YOLO_IMGSZ)
+    except ValueError as e:
+        logger.warning(f"Cannot use {engine_path}, using {model_path}: {str(e)}")
+        return YOLO(model_path)
+    return yolo_model
+
+
+_yolo_model: Optional[YOLO] = None
+_yolo_model_loader: Optional[threading.Thread] = None
+_yolo_model_lock = threading.Lock()
+
+
+def _load_yolo_model() -> None:
+    global _yolo_model
+    try:
+        _yolo_model = load_yolo_model(MODEL_PATH)
+        logger.info(f"Loaded YOLO model from {MODEL_PATH}")
+    except Exception as e:
+        logger.error(f"Failed to load YOLO model, detection is disabled: {str(e)}")
+
+
+def start_loading_yolo_model() -> None:
+    """
+    Start loading the YOLO model in a background thread, once per process.
+    Called at startup: on a NVIDIA GPU, the first load builds the TensorRT engine,
+    which takes minutes. A failed load is not retried.
+    """
+    global _yolo_model_loader
+    if _yolo_model_loader is None:
+        with _yolo_model_lock:
+            if _yolo_model_loader is None:
+                _yolo_model_loader = threading.Thread(
+                    target=_load_yolo_model, name="yolo-model-loader", daemon=True
+                )
+                _yolo_model_loader.start()
+
+
+def get_yolo_model() -> Optional[YOLO]:
+    """
+    Return the YOLO model of the process, or None while it loads or if it failed
+    to load. The video streams are sent without detections in the meantime.
+    """
+    start_loading_yolo_model()
+    return _yolo_model
+
+
+def _detect(frame: np.ndarray) -> tuple[np.ndarray, list[str], list[dict]]:
+    """
+    Run YOLO detection on a BGR frame.
+    Returns the int32 [x1, y1, x2, y2] boxes to draw, their labels and the detections.
+    """
     try:
         # Run YOLO detection
-        results = yolo_model(frame, verbose=False)[0]
-        
-        # Process detections
-        detections = []
-        for r in results.boxes.data.tolist():
-            x1, y1, x2, y2, score, class_id = r
-            class_name = results.names[int(class_id)]
-            
-            detections.append({
-                'class': class_name,
-                'confidence': float(score),
-                'bbox': [float(x1), float(y1), float(x2), float(y2)]
-            })
-            
-            # Draw bounding box and label
-            cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 2)
-            label = f"{class_name}: {score:.2f}"
-            cv2.putText(frame, label, (int(x1), int(y1) - 10), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-        
-        return frame, detections
+        yolo_model = get_yolo_model()
+        if yolo_model is None:
+            return np.empty((0, 4), dtype=np.int32), [], []
+        with _yolo_lock:
+            results = yolo_model(
+                frame,
+                imgsz=YOLO_IMGSZ,
+                half=YOLO_HALF,
+                conf=YOLO_CONF,
+                iou=0.45,
+                max_det=10,
+                verbose=False,
+            )[0]
+
+        data = torch.as_tensor(results.boxes.data).float().cpu().numpy()
+        return format_detections(data, results.names, YOLO_CONF)
     except Exception as e:
         logger.error(f"Error in YOLO detection: {str(e)}")
-        return frame, []
+        return np.empty((0, 4), dtype=np.int32), [], []
+
+
+def process_frame(frame: np.ndarray) -> tuple[np.ndarray, list[dict]]:
+    """Process frame with YOLO detection."""
+    xyxy, labels, detections = _detect(frame)
+    draw_detections(frame, xyxy, labels)
+    return frame, detections
+
+
+def detect_and_encode_jpeg(frame: np.ndarray, quality: int) -> bytes | memoryview:
+    """
+    Run YOLO detection on a BGR frame and encode it as JPEG with the detections drawn.
+    With nvJPEG, the frame is uploaded once, annotated and encoded on the GPU.
+    """
+    xyxy, labels, _ = _detect(frame)
+    if len(xyxy) == 0 or not _nvjpeg_available():
+        draw_detections(frame, xyxy, labels)
+        return _encode_jpeg(frame, quality)
+
+    image = torch.from_numpy(frame).to("cuda")
+    draw_detections_on_tensor(image, xyxy, labels)
+    return _encode_jpeg_cuda(image, quality, rgb=False)
+
+def _fit_to_model_input(frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+    """Downscale a frame to YOLO_IMGSZ on its long side, keeping its aspect ratio."""
+    height, width = frame.shape[:2]
+    ratio = YOLO_IMGSZ / max(height, width)
+    if ratio >= 1:
+        return frame
+    return cv2.resize(
+        frame,
+        (round(width * ratio), round(height * ratio)),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def _detect_and_encode_rgb_frame(
+    frame: cv2.typing.MatLike, fit_to_model_input: bool, quality: int
+) -> tuple[bytes | memoryview, Optional[Exception]]:
+    """
+    Run YOLO detection on a RGB camera frame and encode it as JPEG with the detections
+    drawn, first downscaling it to the model input if fit_to_model_input is True.
+    If the detection fails, the frame is encoded without detections and the error is
+    returned with it.
+    """
+    if fit_to_model_input:
+        frame = _fit_to_model_input(frame)
+
+    # Convert RGB to BGR once: YOLO (numpy input) expects BGR, and so does the encoder
+    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    try:
+        return detect_and_encode_jpeg(frame, quality), None
+    except Exception as e:
+        return _encode_jpeg(frame, quality), e
+
 
 @router.get(
     "/video/{camera_id}",
@@ -92,12 +290,17 @@ def video_feed_for_camera(
     - target_size (tuple[int, int] | None): Target size of the video feed. Default is None.
     - quality (int | None): Quality of the video feed. Default is None.
     - enable_detection (bool): Whether to enable YOLO object detection. Default is True.
+
+    When detection is enabled and no size is requested, frames are downscaled to the model
+    input size (640 pixels on the long side, keeping the aspect ratio), so YOLO does not
+    resize them again. The video is then sent at that resolution; the client may upscale it.
     """
 
     if width is None or height is None:
         target_size = None
     else:
         target_size = (width, height)
+    fit_to_model_input = enable_detection and target_size is None
     logger.debug(
         f"Received request for camera {camera_id} with target size {target_size} and quality {quality}"
     )
@@ -125,18 +328,46 @@ def video_feed_for_camera(
         "quality": quality,
     }
 
+    jpeg_quality = quality if quality else 80
+
     async def generate_frames():
+        # Set while no YOLO inference runs for this stream. The camera is not read during
+        # an inference, so frames never pile up when the GPU falls behind
+        inference_idle = asyncio.Event()
+        inference_idle.set()
+        inference_task: asyncio.Task | None = None
+        last_jpeg: bytes | memoryview | None = None
+
+        detection_failed = False
+
+        def read_frame(camera) -> Optional[cv2.typing.MatLike]:
+            if camera_id == "depth":
+                return camera.get_depth_frame(resize=target_size)
+            return camera.get_rgb_frame(resize=target_size)
+
+        async def detect_and_encode(frame: cv2.typing.MatLike) -> None:
+            nonlocal last_jpeg, detection_failed
+            try:
+                last_jpeg, error = await asyncio.to_thread(
+                    _detect_and_encode_rgb_frame, frame, fit_to_model_input, jpeg_quality
+                )
+                # Warn once per stream, the error is likely to repeat on every frame
+                if error is not None and not detection_failed:
+                    logger.warning(f"Detection failed, sending the frames without detections: {str(error)}")
+                    detection_failed = True
+            finally:
+                inference_idle.set()
+
         try:
             while True:
                 if request.client is None:
                     break
 
-                # Get frame from camera
+                # Get the camera
                 if isinstance(camera_id, int):
                     camera = cameras.get_camera_by_id(camera_id)
                     if camera is None or not camera.is_active:
                         raise HTTPException(status_code=404, detail="Camera not available")
-                    frame = camera.get_rgb_frame(resize=target_size)
                 else:
                     if camera_id not in ["realsense", "depth"]:
                         raise HTTPException(
@@ -146,31 +377,51 @@ def video_feed_for_camera(
                     camera = cameras.get_realsense_camera()
                     if camera is None:
                         raise HTTPException(status_code=404, detail="Camera not available")
-                    frame = camera.get_rgb_frame(resize=target_size) if camera_id == "realsense" else camera.get_depth_frame(resize=target_size)
-
-                if frame is None:
-                    continue
 
-                # Convert RGB to BGR for OpenCV
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-                # Process frame with YOLO if enabled
+                # Inference and encoding run in worker threads (cv2 and torch release the GIL)
+                # so that a slow camera does not block the event loop for the other streams
                 if enable_detection:
-                    frame, _ = process_frame(frame)
-
-                # Convert back to RGB for streaming
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # Encode frame
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality if quality else 80])
-                frame_bytes = buffer.tobytes()
+                    # Process the latest frame with YOLO, unless an inference is still running
+                    if inference_idle.is_set():
+                        # Even the encoding of the frame without detections failed: end the
+                        # stream instead of starting a new inference for every frame
+                        if inference_task is not None and inference_task.done():
+                            error = inference_task.exception()
+                            if error is not None:
+                                raise error
+                        frame = read_frame(camera)
+                        if frame is None:
+                            continue
+                        inference_idle.clear()
+                        inference_task = asyncio.create_task(detect_and_encode(frame))
+
+                    # Send the annotated frame when ready, or the previous one after a camera
+                    # frame interval, so that the stream keeps the camera pace
+                    try:
+                        await asyncio.wait_for(inference_idle.wait(), timeout=1 / camera.fps)
+                    except asyncio.TimeoutError:
+                        pass
+                    if last_jpeg is None:
+                        continue
+                    jpeg = last_jpeg
+                else:
+                    frame = read_frame(camera)
+                    if frame is None:
+                        continue
+                    # Encode the RGB frame
+                    jpeg = await asyncio.to_thread(_encode_jpeg, frame, jpeg_quality, True)
 
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+                # Send the JPEG buffer as is, without copying it into a new bytes object
+                yield _FRAME_PREFIX
+                yield jpeg
+                yield _FRAME_SUFFIX
 
         except Exception as e:
             logger.error(f"Error in video stream: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            if inference_task is not None:
+                inference_task.cancel()
 
     return StreamingResponse(
         generate_frames(),
@@ -178,6 +429,31 @@ def video_feed_for_camera(
     )
 
 
+def _json_response(content: object) -> Response:
+    """Serialize a JSON response with orjson, much faster than the stdlib encoder."""
+    return Response(
+        content=orjson.dumps(content),
+        media_type="application/json",
+    )
+
+
+def _encode_frame_base64(frame: cv2.typing.MatLike) -> str:
+    """Convert a RGB frame to a base64 encoded JPG."""
+    # Encode frame as JPG (same quality as the OpenCV default)
+    jpeg = _encode_jpeg(frame, quality=95, rgb=True)
+
+    # Convert to base64 string
+    return pybase64.b64encode(jpeg).decode("ascii")
+
+
+async def _encode_one(camera_id: str, frame: cv2.typing.MatLike) -> tuple[str, str]:
+    """
+    Encode a camera frame in a worker thread.
+    OpenCV and pybase64 release the GIL, so cameras are encoded in parallel.
+    """
+    return camera_id, await asyncio.to_thread(_encode_frame_base64, frame)
+
+
 @router.get(
     "/frames",
     response_model=Dict[str, Optional[str]],
@@ -202,7 +478,7 @@ def video_feed_for_camera(
 )
 async def get_all_camera_frames(
     cameras: AllCameras = Depends(get_all_cameras),
-) -> Dict[str, Optional[str]]:
+) -> Response:
     """
     Capture and return frames from all available cameras.
     Returns:
@@ -214,35 +490,29 @@ async def get_all_camera_frames(
     # We can add a resize here if needed
     frames = cameras.get_rgb_frames_for_all_cameras()
 
-    # Initialize response dictionary
-    response: Dict[str, Optional[str]] = {}
-
-    # Process each frame
-    for camera_id, frame in frames.items():
-        try:
-            if frame is None:
-                response[camera_id] = None
-                continue
-
-            # Convert BGR to RGB
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Encode frame as JPG
-            _, buffer = cv2.imencode(".jpg", rgb_frame)
-
-            # Convert to base64 string
-            base64_frame = base64.b64encode(buffer.tobytes()).decode("utf-8")
+    # Encode the cameras concurrently, each in its own worker thread
+    available_frames = [
+        (camera_id, frame) for camera_id, frame in frames.items() if frame is not None
+    ]
+    results = await asyncio.gather(
+        *(_encode_one(camera_id, frame) for camera_id, frame in available_frames),
+        return_exceptions=True,
+    )
 
-            response[camera_id] = base64_frame
-
-        except Exception as e:
-            logger.error(f"Error processing frame for camera {camera_id}: {str(e)}")
-            response[camera_id] = None
+    # Cameras without a frame or whose encoding failed are set to None
+    response: Dict[str, Optional[str]] = {camera_id: None for camera_id in frames}
+    for (camera_id, _), result in zip(available_frames, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Error processing frame for camera {camera_id}: {str(result)}")
+            continue
+        response[camera_id] = result[1]
 
     if not response:
         raise HTTPException(status_code=503, detail="No camera frames available")
 
-    return response
+    # The base64 strings are large: orjson serializes them much faster than the
+    # jsonable_encoder of FastAPI < 0.130 (later versions serialize through pydantic)
+    return _json_response(response)
 
 @router.get(
     "/depth/measurement",
@@ -283,23 +553,22 @@ def get_depth_measurement(
         ]
 
         # Calculate average depth (excluding zeros/invalid values)
-        valid_depths = center_region[center_region > 0]
-        if len(valid_depths) == 0:
+        # OpenCV computes the statistics under a mask, without copying the valid depths
+        mask = (center_region > 0).view(np.uint8)
+        valid_count = cv2.countNonZero(mask)
+        if valid_count == 0:
             logger.warning("No valid depth measurements in center region")
             return {"distance": 0.0, "confidence": 0.0}
 
         # Calculate statistics
-        avg_depth = float(np.mean(valid_depths))
-        min_depth = float(np.min(valid_depths))
-        max_depth = float(np.max(valid_depths))
+        mean, std = cv2.meanStdDev(center_region, mask=mask)
+        avg_depth = float(mean[0, 0])
+        std_dev = float(std[0, 0])
         
         # Calculate confidence based on:
         # 1. Percentage of valid measurements
         # 2. Consistency of measurements (std dev)
-        # 3. Reasonable depth range
-        valid_ratio = float(len(valid_depths) / center_region.size)
-        std_dev = float(np.std(valid_depths))
-        depth_range = max_depth - min_depth
+        valid_ratio = valid_count / center_region.size
         
         # Combine factors for confidence
         confidence = valid_ratio * (1.0 - min(1.0, std_dev / avg_depth if avg_depth > 0 else 1.0))
@@ -307,10 +576,15 @@ def get_depth_measurement(
         # Log detailed information about the depth measurement
         logger.debug(f"Depth frame shape: {depth_frame.shape}")
         logger.debug(f"Center region shape: {center_region.shape}")
-        logger.debug(f"Number of valid depth measurements: {len(valid_depths)}")
+        logger.debug(f"Number of valid depth measurements: {valid_count}")
         logger.debug(f"Average depth: {avg_depth:.3f}m")
-        logger.debug(f"Min depth: {min_depth:.3f}m")
-        logger.debug(f"Max depth: {max_depth:.3f}m")
+        # Min and max are only computed when debug logs are enabled
+        logger.opt(lazy=True).debug(
+            "Min/max depth: {}",
+            lambda: "{:.3f}m / {:.3f}m".format(
+                *cv2.minMaxLoc(center_region, mask=mask)[:2]
+            ),
+        )
         logger.debug(f"Standard deviation: {std_dev:.3f}m")
         logger.debug(f"Confidence: {confidence:.1%}")
 
@@ -0,0 +1,296 @@
+"""
+Tests for the camera endpoints.
+
+```
+uv run pytest tests/phosphobot/test_camera_endpoints.py
+```
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import orjson
+import pybase64
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import phosphobot.endpoints.camera as camera
+from fastapi import HTTPException
+
+from phosphobot.endpoints.camera import (
+    _detect,
+    get_all_camera_frames,
+    get_depth_measurement,
+    get_yolo_model,
+    video_feed_for_camera,
+)
+
+
+class FakeRealSenseCamera:
+    def __init__(self, depth_frame: np.ndarray):
+        self.depth_frame = depth_frame
+
+    def get_depth_frame(self) -> np.ndarray:
+        return self.depth_frame
+
+
+class FakeCameras:
+    def __init__(self, depth_frame: np.ndarray):
+        self.camera = FakeRealSenseCamera(depth_frame)
+
+    def get_realsense_camera(self) -> FakeRealSenseCamera:
+        return self.camera
+
+
+@pytest.fixture
+def depth_frame() -> np.ndarray:
+    """
+    Depth frame in meters, with invalid (zero) measurements
+    """
+    rng = np.random.default_rng(0)
+    depth = rng.uniform(0.5, 0.7, (480, 640))
+    depth[rng.uniform(size=depth.shape) < 0.2] = 0
+    return depth
+
+
+def test_depth_measurement_matches_numpy(depth_frame: np.ndarray) -> None:
+    """
+    The masked OpenCV statistics match the NumPy ones on the valid depths
+    """
+    result = get_depth_measurement(cameras=FakeCameras(depth_frame))  # type: ignore
+
+    # Same center region as the endpoint
+    height, width = depth_frame.shape
+    region_size = min(width, height) // 5
+    center_region = depth_frame[
+        height // 2 - region_size // 2 : height // 2 + region_size // 2,
+        width // 2 - region_size // 2 : width // 2 + region_size // 2,
+    ]
+    valid = center_region[center_region > 0]
+    expected_confidence = (valid.size / center_region.size) * (
+        1.0 - min(1.0, valid.std() / valid.mean())
+    )
+
+    assert result["distance"] == pytest.approx(valid.mean())
+    assert result["confidence"] == pytest.approx(expected_confidence)
+
+
+def test_depth_measurement_without_valid_depth() -> None:
+    result = get_depth_measurement(cameras=FakeCameras(np.zeros((480, 640))))  # type: ignore
+    assert result == {"distance": 0.0, "confidence": 0.0}
+
+
+@pytest.fixture
+def yolo_loads(monkeypatch: pytest.MonkeyPatch) -> list:
+    """
+    Reset the YOLO model of the process, and record the loads
+    """
+    loads: list = []
+    monkeypatch.setattr(camera, "_yolo_model", None)
+    monkeypatch.setattr(camera, "_yolo_model_loader", None)
+    return loads
+
+
+def test_failed_yolo_model_load_is_not_retried(
+    monkeypatch: pytest.MonkeyPatch, yolo_loads: list
+) -> None:
+    def load_yolo_model(model_path: str) -> None:
+        yolo_loads.append(model_path)
+        raise RuntimeError("no weights")
+
+    monkeypatch.setattr(camera, "load_yolo_model", load_yolo_model)
+
+    # Streams starting together
+    threads = [threading.Thread(target=get_yolo_model) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert camera._yolo_model_loader is not None
+    camera._yolo_model_loader.join()
+
+    assert get_yolo_model() is None
+    assert len(yolo_loads) == 1
+
+
+def test_detect_while_yolo_model_loads(
+    monkeypatch: pytest.MonkeyPatch, yolo_loads: list
+) -> None:
+    """
+    The frames are not held back while the model loads: they have no detections
+    """
+    loaded = threading.Event()
+    model = object()
+
+    def load_yolo_model(model_path: str) -> object:
+        yolo_loads.append(model_path)
+        loaded.wait()
+        return model
+
+    monkeypatch.setattr(camera, "load_yolo_model", load_yolo_model)
+
+    xyxy, labels, detections = _detect(np.zeros((48, 64, 3), dtype=np.uint8))
+    assert xyxy.shape == (0, 4)
+    assert labels == [] and detections == []
+
+    loaded.set()
+    assert camera._yolo_model_loader is not None
+    camera._yolo_model_loader.join()
+    assert get_yolo_model() is model
+    assert len(yolo_loads) == 1
+
+
+class FakeVideoCamera:
+    is_active = True
+    fps = 100
+
+    def __init__(self):
+        self.reads = 0
+
+    def get_rgb_frame(self, resize=None) -> np.ndarray:
+        self.reads += 1
+        return np.zeros((48, 64, 3), dtype=np.uint8)
+
+
+class FakeVideoCameras:
+    def __init__(self):
+        self.camera = FakeVideoCamera()
+
+    def get_camera_by_id(self, camera_id: int) -> FakeVideoCamera:
+        return self.camera
+
+
+async def stream_frames(cameras: FakeVideoCameras, n_frames: int) -> list:
+    """
+    JPEGs of the first n_frames frames of the video stream of a camera
+    """
+    response = video_feed_for_camera(
+        request=SimpleNamespace(client="client"),  # type: ignore
+        camera_id=0,
+        cameras=cameras,  # type: ignore
+    )
+    body = response.body_iterator
+    jpegs: list = []
+    try:
+        async for chunk in body:
+            # Each frame is sent as a multipart prefix, the JPEG, then a suffix
+            if not bytes(chunk).startswith(b"--frame") and chunk != b"\r\n":
+                jpegs.append(bytes(chunk))
+            if len(jpegs) == n_frames:
+                break
+    finally:
+        await body.aclose()  # type: ignore
+    return jpegs
+
+
+@pytest.mark.asyncio
+async def test_video_stream_reads_the_camera_only_when_detection_is_idle(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    inferences = []
+    running = threading.Semaphore(1)
+
+    def detect_and_encode(frame, fit_to_model_input: bool, quality: int):
+        # Slower than the camera frame interval, and never two at a time
+        assert running.acquire(blocking=False)
+        inferences.append(frame.shape)
+        time.sleep(0.05)
+        running.release()
+        return b"annotated", None
+
+    monkeypatch.setattr(camera, "_detect_and_encode_rgb_frame", detect_and_encode)
+    cameras = FakeVideoCameras()
+
+    jpegs = await stream_frames(cameras, 20)
+    # The previous JPEG is sent again while the detection runs
+    assert set(jpegs) == {b"annotated"}
+    assert len(inferences) < len(jpegs)
+    assert cameras.camera.reads == len(inferences)
+
+
+@pytest.mark.asyncio
+async def test_video_stream_without_detections_when_detection_fails(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def detect_and_encode_jpeg(frame: np.ndarray, quality: int):
+        raise RuntimeError("detection failed")
+
+    monkeypatch.setattr(camera, "detect_and_encode_jpeg", detect_and_encode_jpeg)
+    monkeypatch.setattr(camera, "_encode_jpeg", lambda frame, quality: b"plain")
+
+    assert set(await stream_frames(FakeVideoCameras(), 5)) == {b"plain"}
+
+
+@pytest.mark.asyncio
+async def test_video_stream_ends_when_encoding_fails(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    def fail(*args):
+        raise RuntimeError("encoding failed")
+
+    monkeypatch.setattr(camera, "detect_and_encode_jpeg", fail)
+    monkeypatch.setattr(camera, "_encode_jpeg", fail)
+    cameras = FakeVideoCameras()
+
+    with pytest.raises(HTTPException):
+        await asyncio.wait_for(stream_frames(cameras, 5), timeout=5)
+    # No new inference is started once the encoding failed
+    assert cameras.camera.reads == 1
+
+
+class FakeFrameCameras:
+    def __init__(self, frames: dict):
+        self.frames = frames
+
+    def get_rgb_frames_for_all_cameras(self) -> dict:
+        return self.frames
+
+
+@pytest.mark.asyncio
+async def test_all_camera_frames(monkeypatch: pytest.MonkeyPatch) -> None:
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    broken_frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    encode_frame_base64 = camera._encode_frame_base64
+
+    def encode_or_fail(frame: np.ndarray) -> str:
+        if frame is broken_frame:
+            raise RuntimeError("encoding failed")
+        return encode_frame_base64(frame)
+
+    monkeypatch.setattr(camera, "_encode_frame_base64", encode_or_fail)
+    cameras = FakeFrameCameras({"0": frame, "1": None, "realsense": broken_frame})
+
+    response = await get_all_camera_frames(cameras=cameras)  # type: ignore
+    frames = orjson.loads(response.body)
+
+    # Cameras without a frame or whose encoding failed are None
+    assert frames["1"] is None
+    assert frames["realsense"] is None
+    jpeg = pybase64.b64decode(frames["0"])
+    assert jpeg.startswith(b"\xff\xd8")
+
+
+@pytest.mark.asyncio
+async def test_all_camera_frames_are_encoded_in_parallel(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Each encoding waits for the other one: they only finish if they run together
+    barrier = threading.Barrier(2, timeout=5)
+
+    def encode_frame_base64(frame: np.ndarray) -> str:
+        barrier.wait()
+        return "jpeg"
+
+    monkeypatch.setattr(camera, "_encode_frame_base64", encode_frame_base64)
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+
+    response = await get_all_camera_frames(
+        cameras=FakeFrameCameras({"0": frame, "1": frame})  # type: ignore
+    )
+    assert orjson.loads(response.body) == {"0": "jpeg", "1": "jpeg"}
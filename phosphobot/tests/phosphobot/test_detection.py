@@ -0,0 +1,217 @@
+"""
+Tests for the YOLO detection helpers.
+
+```
+uv run pytest tests/phosphobot/test_detection.py
+```
+"""
+
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import phosphobot.detection
+from phosphobot.detection import (
+    _label_pieces,
+    _postprocess_loop,
+    _postprocess_numpy,
+    draw_detections,
+    check_engine_input,
+    draw_detections_on_tensor,
+    engine_path_for,
+    export_engine,
+    format_detections,
+    postprocess_detections,
+)
+
+
+@pytest.fixture
+def detections() -> np.ndarray:
+    """
+    Random YOLO detections [x1, y1, x2, y2, score, class_id]
+    """
+    rng = np.random.default_rng(0)
+    data = np.empty((50, 6), dtype=np.float32)
+    data[:, :2] = rng.uniform(0, 500, (50, 2))
+    data[:, 2:4] = data[:, :2] + rng.uniform(0, 200, (50, 2))
+    data[:, 4] = rng.uniform(0, 1, 50)
+    data[:, 5] = rng.integers(0, 80, 50)
+    return data
+
+
+@pytest.mark.parametrize("postprocess", [_postprocess_loop, postprocess_detections])
+def test_postprocess_matches_numpy(detections: np.ndarray, postprocess) -> None:
+    """
+    The loop version (compiled with Numba if available) matches NumPy
+    """
+    expected = _postprocess_numpy(detections, 0.5)
+    result = postprocess(detections, 0.5)
+
+    assert len(result) == len(expected)
+    for array, expected_array in zip(result, expected):
+        assert array.dtype == expected_array.dtype
+        np.testing.assert_array_equal(array, expected_array)
+
+
+def test_postprocess_without_detections() -> None:
+    keep, boxes, scores, class_ids = postprocess_detections(
+        np.empty((0, 6), dtype=np.float32), 0.5
+    )
+    assert keep.shape == (0,)
+    assert boxes.shape == (0, 4)
+    assert scores.shape == (0,)
+    assert class_ids.shape == (0,)
+
+
+def test_format_detections() -> None:
+    data = np.array(
+        [[10.5, 20, 110, 220.5, 0.87, 1], [0, 0, 5, 5, 0.2, 0]], dtype=np.float32
+    )
+    xyxy, labels, detections = format_detections(data, {0: "person", 1: "car"}, 0.5)
+
+    np.testing.assert_array_equal(xyxy, [[10, 20, 110, 220]])
+    assert labels == ["car: 0.87"]
+    assert detections == [
+        {"class": "car", "confidence": pytest.approx(0.87), "bbox": [10.5, 20, 110, 220.5]}
+    ]
+
+
+def test_label_pieces() -> None:
+    assert _label_pieces("traffic light: 0.87") == ["traffic light: ", "0", ".", "8", "7"]
+    assert _label_pieces("person") == ["person"]
+
+
+def test_draw_detections_on_tensor_matches_opencv() -> None:
+    """
+    Drawing on a tensor (here on CPU) touches the same pixels as OpenCV,
+    except for the rounded outer corners of the boxes
+    """
+    rng = np.random.default_rng(0)
+    frame = np.full((240, 320, 3), 50, dtype=np.uint8)
+    # Boxes inside the frame, partly outside, and a label clipped at the top
+    xyxy = np.array(
+        [[20, 40, 150, 180], [-5, 5, 330, 100], [250, 150, 319, 239]], dtype=np.int32
+    )
+    labels = [f"person: {rng.random():.2f}" for _ in range(len(xyxy))]
+
+    expected = frame.copy()
+    draw_detections(expected, xyxy, labels)
+    image = torch.from_numpy(frame.copy())
+    draw_detections_on_tensor(image, xyxy, labels)
+
+    expected_mask = (expected != 50).any(axis=2)
+    mask = (image.numpy() != 50).any(axis=2)
+    # At most the 4 outer corner pixels of each box differ
+    assert (expected_mask ^ mask).sum() <= 4 * len(xyxy)
+    assert (image.numpy()[mask] == (0, 255, 0)).all()
+
+
+def test_draw_detections_on_tensor_without_device_sync() -> None:
+    """
+    No boolean mask indexing, which runs nonzero and waits for the device on CUDA
+    """
+    image = torch.full((240, 320, 3), 50, dtype=torch.uint8)
+    xyxy = np.array([[20, 40, 150, 180]], dtype=np.int32)
+    with torch.profiler.profile() as profile:
+        draw_detections_on_tensor(image, xyxy, ["person: 0.87"])
+
+    assert "aten::nonzero" not in {event.name for event in profile.events()}
+
+
+def test_draw_detections_on_tensor_without_detections() -> None:
+    image = torch.full((32, 32, 3), 50, dtype=torch.uint8)
+    draw_detections_on_tensor(image, np.empty((0, 4), dtype=np.int32), [])
+    assert (image == 50).all()
+
+
+def test_engine_path_for() -> None:
+    assert engine_path_for("weights/yolov8n.pt", 640).name == "yolov8n_fp16_b1_640.engine"
+    assert (
+        engine_path_for("weights/yolov8n.pt", 640, int8=True).name
+        == "yolov8n_int8_b1_640.engine"
+    )
+
+
+class FakeEngineModel:
+    """
+    Stands for a YOLO model loaded from a TensorRT engine with the given input shape
+    """
+
+    def __init__(self, input_shape: tuple):
+        self.predictor = None
+        self.input_shape = input_shape
+
+    def __call__(self, *args, **kwargs) -> None:
+        bindings = {"images": SimpleNamespace(shape=self.input_shape)}
+        self.predictor = SimpleNamespace(model=SimpleNamespace(bindings=bindings))
+
+
+def test_check_engine_input() -> None:
+    check_engine_input(FakeEngineModel((1, 3, 640, 640)), 640)  # type: ignore
+    with pytest.raises(ValueError):
+        check_engine_input(FakeEngineModel((8, 3, 640, 640)), 640)  # type: ignore
+
+
+class FakeYOLO:
+    """
+    Export like ultralytics: an intermediate ONNX model, then the engine, next to the weights
+    """
+
+    exports = 0
+
+    def __init__(self, model_path: str):
+        self.weights = Path(model_path)
+
+    def export(self, **kwargs) -> str:
+        FakeYOLO.exports += 1
+        self.weights.with_suffix(".onnx").write_bytes(b"onnx")
+        engine = self.weights.with_suffix(".engine")
+        engine.write_bytes(b"engine")
+        return str(engine)
+
+
+@pytest.fixture
+def fake_yolo(monkeypatch: pytest.MonkeyPatch) -> type[FakeYOLO]:
+    FakeYOLO.exports = 0
+    monkeypatch.setattr(phosphobot.detection, "YOLO", FakeYOLO)
+    return FakeYOLO
+
+
+def test_export_engine(tmp_path: Path, fake_yolo: type[FakeYOLO]) -> None:
+    """
+    The engine is exported once, and the intermediate ONNX model is removed
+    """
+    weights = str(tmp_path / "yolov8n.pt")
+
+    engine_path = export_engine(weights, 640)
+    assert engine_path.exists()
+    assert not (tmp_path / "yolov8n.onnx").exists()
+
+    # The engine is reused
+    assert export_engine(weights, 640) == engine_path
+    assert fake_yolo.exports == 1
+
+
+def test_export_engine_keeps_existing_onnx(
+    tmp_path: Path, fake_yolo: type[FakeYOLO]
+) -> None:
+    onnx_path = tmp_path / "yolov8n.onnx"
+    onnx_path.write_bytes(b"user model")
+
+    export_engine(str(tmp_path / "yolov8n.pt"), 640)
+    assert onnx_path.exists()
+
+
+def test_export_int8_engine_requires_calibration_data(
+    tmp_path: Path, fake_yolo: type[FakeYOLO]
+) -> None:
+    with pytest.raises(ValueError):
+        export_engine(str(tmp_path / "yolov8n.pt"), 640, int8=True)
+    assert fake_yolo.exports == 0